@@ -1,132 +1,96 @@
 import os
-import json
+import base64
+import binascii
+import hashlib
+import hmac
 import logging
-from flask import Flask, request, abort
+import re
 
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, FlexSendMessage
+import httpx
+import orjson
+from quart import Quart, request, abort
 
-import google.generativeai as genai
+from redis import Redis
+from rq import Queue
 
-app = Flask(__name__)
+from tasks import process_food_request
 
-# 設定 Log
-logging.basicConfig(level=logging.INFO)
+app = Quart(__name__)
+
+# 設定 Log：正式環境預設 WARNING，訊息內容用 %s 延遲格式化，被濾掉時零成本
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING'))
 
 # 1. 讀取金鑰
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET')
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+LINE_REPLY_URL = "https://api.line.me/v2/bot/message/reply"
 
-# 2. 設定 Gemini 與除錯資訊
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    
-    # 強制印出版本與模型清單 (Debug 用)
-    print(f"【系統檢查】目前 GenAI 套件版本: {genai.__version__}", flush=True)
-    try:
-        print("【系統檢查】正在查詢可用模型...", flush=True)
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                print(f" - 可用: {m.name}", flush=True)
-    except Exception as e:
-        print(f"【系統檢查】無法列出模型 (可能 Key 有誤): {e}", flush=True)
-
-    # 設定模型 (使用目前最通用的 1.5-flash)
-    model = genai.GenerativeModel('gemini-1.5-flash')
-else:
-    print("【嚴重錯誤】找不到 GEMINI_API_KEY，請檢查 Render 環境變數！", flush=True)
-
-# 3. 核心功能：取得推薦
-def get_gemini_recommendation(location, food_type, budget):
-    prompt = f"""
-    你是一個美食導遊。請推薦 3 間位於「{location}」的「{food_type}」，預算「{budget}」。
-    規則：
-    1. 回傳純 JSON Array。
-    2. 不要 Markdown。
-    3. 欄位: name, rating, address, description。
-    """
+# 共用的連線池 (HTTP/2 + keep-alive)，回 LINE 時不用每次重新握手
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+    headers={"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"},
+)
+
+# 2. 背景任務佇列：Gemini 要跑好幾秒，丟給 RQ worker 處理，webhook 馬上回 200
+redis_conn = Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+queue = Queue('food-requests', connection=redis_conn)
+
+# 訊息切割：一次掃描同時吃逗號和空白
+_SPLIT_RE = re.compile(r'[,\s]+')
+
+# 3. 簽章驗證：一次 HMAC-SHA256 就能擋掉非 LINE 的垃圾請求，不用先解析 JSON
+def valid_signature(body, signature):
+    mac = hmac.new(LINE_CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()
     try:
-        response = model.generate_content(
-            prompt,
-            generation_config={"response_mime_type": "application/json"}
-        )
-        return json.loads(response.text)
-    except Exception as e:
-        logging.error(f"Gemini 生成失敗: {e}")
-        return []
-
-# 4. 製作卡片
-def create_bubble(store):
-    return {
-        "type": "bubble",
-        "size": "micro",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {"type": "text", "text": store.get('name', '店名'), "weight": "bold", "wrap": True},
-                {"type": "text", "text": f"⭐ {store.get('rating', 'N/A')}", "size": "xs", "color": "#ffc107"},
-                {"type": "text", "text": store.get('address', '地址'), "size": "xxs", "color": "#aaaaaa", "wrap": True},
-                {"type": "text", "text": store.get('description', ''), "size": "xxs", "wrap": True, "margin": "md"}
-            ]
-        },
-        "footer": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "button",
-                    "action": {
-                        "type": "uri",
-                        "label": "查看地圖",
-                        "uri": f"https://www.google.com/maps/search/?api=1&query={store.get('name')}"
-                    },
-                    "height": "sm",
-                    "style": "link"
-                }
-            ]
-        }
-    }
-
-# 5. LINE Webhook
+        expected = base64.b64decode(signature)
+    except (binascii.Error, ValueError):
+        return False
+    return hmac.compare_digest(mac, expected)
+
+# 4. 回覆訊息 (只給不用排隊的快速回覆用，例如輸入格式提示)
+async def reply_message(reply_token, messages):
+    resp = await http_client.post(
+        LINE_REPLY_URL,
+        json={"replyToken": reply_token, "messages": messages}
+    )
+    resp.raise_for_status()
+
+# 5. LINE Webhook：驗證簽章、解析、進佇列，毫秒級回應
 @app.route("/callback", methods=['POST'])
-def callback():
-    signature = request.headers['X-Line-Signature']
-    body = request.get_data(as_text=True)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+async def callback():
+    signature = request.headers.get('X-Line-Signature', '')
+    body = await request.get_data()
+    if not valid_signature(body, signature):
+        logging.info("簽章驗證失敗，拒絕請求")
         abort(400)
+
+    logging.debug("Request body: %s", body)
+    payload = orjson.loads(body)
+    for event in payload.get('events', []):
+        message = event.get('message', {})
+        if event.get('type') == 'message' and message.get('type') == 'text':
+            await handle_message(event['replyToken'], message['text'])
     return 'OK'
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    msg = event.message.text.strip()
-    inputs = msg.replace(',', ' ').split()
-    
+async def handle_message(reply_token, text):
+    # 開頭是逗號時 re.split 會多出一個空字串，要濾掉，不然欄位會整個位移
+    inputs = [t for t in _SPLIT_RE.split(text.strip()) if t]
+
     if len(inputs) >= 2:
         location = inputs[0]
-        food_type = inputs[1]
-        budget = inputs[2] if len(inputs) > 2 else "不限"
-        
-        try:
-            stores = get_gemini_recommendation(location, food_type, budget)
-            if not stores:
-                line_bot_api.reply_message(event.reply_token, TextMessage(text="抱歉，AI 找不到資料。"))
-                return
-            
-            bubbles = [create_bubble(s) for s in stores]
-            line_bot_api.reply_message(event.reply_token, FlexSendMessage(alt_text="推薦結果", contents={"type": "carousel", "contents": bubbles}))
-        except Exception as e:
-            logging.error(f"處理失敗: {e}")
-            line_bot_api.reply_message(event.reply_token, TextMessage(text="系統發生錯誤，請稍後再試。"))
+        # 超過三個欄位時，中間的都是種類，例如「台中 火鍋 拉麵 500」
+        if len(inputs) > 3:
+            food_types = inputs[1:-1]
+            budget = inputs[-1]
+        else:
+            food_types = [inputs[1]]
+            budget = inputs[2] if len(inputs) > 2 else "不限"
+        queue.enqueue(process_food_request, reply_token, location, food_types, budget)
     else:
-        line_bot_api.reply_message(event.reply_token, TextMessage(text="請輸入：地點 種類 價位\n例如：台中 火鍋 500"))
+        await reply_message(reply_token, [{"type": "text", "text": "請輸入：地點 種類 價位\n例如：台中 火鍋 500"}])
 
 if __name__ == "__main__":
     app.run()
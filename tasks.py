@@ -0,0 +1,244 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus
+
+import httpx
+import ijson
+import orjson
+import google.generativeai as genai
+from pydantic import BaseModel
+from redis import Redis
+
+# 設定 Log：正式環境預設 WARNING，訊息內容用 %s 延遲格式化，被濾掉時零成本
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING'))
+
+# 1. 讀取金鑰
+LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+
+LINE_REPLY_URL = "https://api.line.me/v2/bot/message/reply"
+
+# 推薦結果快取：同樣的 (地點, 種類, 預算) 一小時內直接回快取，不再打 Gemini
+redis_conn = Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+CACHE_TTL = 3600
+
+# 共用的連線池 (HTTP/2 + keep-alive)，worker 回 LINE 時不用每次重新握手
+http_client = httpx.Client(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+    headers={"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"},
+)
+
+# 2. 設定 Gemini 與除錯資訊
+if GEMINI_API_KEY:
+    # REST transport 共用同一條 keep-alive 連線，省掉每次呼叫的 TCP+TLS 握手
+    genai.configure(api_key=GEMINI_API_KEY, transport="rest")
+
+    # 印出版本與模型清單 (Debug 用)：list_models 是一整趟網路請求，
+    # 平常不要在冷啟動時跑，要查時設 DEBUG_LIST_MODELS=1
+    if os.environ.get('DEBUG_LIST_MODELS') == '1':
+        print(f"【系統檢查】目前 GenAI 套件版本: {genai.__version__}", flush=True)
+        try:
+            print("【系統檢查】正在查詢可用模型...", flush=True)
+            for m in genai.list_models():
+                if 'generateContent' in m.supported_generation_methods:
+                    print(f" - 可用: {m.name}", flush=True)
+        except Exception as e:
+            print(f"【系統檢查】無法列出模型 (可能 Key 有誤): {e}", flush=True)
+
+    # 設定模型 (使用目前最通用的 1.5-flash)
+    model = genai.GenerativeModel('gemini-1.5-flash')
+else:
+    print("【嚴重錯誤】找不到 GEMINI_API_KEY，請檢查 Render 環境變數！", flush=True)
+
+# 3. 核心功能：取得推薦 (在 worker 裡執行，可以放心阻塞)
+class Store(BaseModel):
+    name: str
+    rating: float
+    address: str
+    description: str
+
+# 提示詞模板只在 import 時建一次，每次呼叫只填三個動態欄位
+_PROMPT_TEMPLATE = """
+    你是一個美食導遊。請推薦 3 間位於「{location}」的「{food_type}」，預算「{budget}」。
+    規則：
+    1. 回傳純 JSON Array。
+    2. 不要 Markdown。
+    3. 欄位: name, rating, address, description。
+    """
+
+def get_gemini_recommendation(location, food_type, budget, on_store=None):
+    prompt = _PROMPT_TEMPLATE.format(location=location, food_type=food_type, budget=budget)
+    # 串流回應：JSON 邊收邊用 ijson 解析，每關閉一個物件就先回呼一間店，
+    # 不用等整包 JSON 收完才開始組卡片。
+    # 注意：這裡只攔「回應格式壞掉」的錯；認證/網路錯誤直接往外拋，
+    # 讓外層任務決定重試，不要默默吞掉還回空清單
+    stream = model.generate_content(
+        prompt,
+        generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": list[Store],
+        },
+        stream=True,
+    )
+    stores = []
+    head = ""
+    items = ijson.sendable_list()
+    coro = ijson.items_coro(items, 'item')
+
+    def _drain():
+        while len(stores) < len(items):
+            store = Store.model_validate(items[len(stores)])
+            stores.append(store)
+            if on_store:
+                on_store(store)
+
+    try:
+        for chunk in stream:
+            text = chunk.text
+            if not text:
+                continue
+            if not head:
+                text = text.lstrip()
+                if not text:
+                    continue
+                # 開頭不是 [ 或 { 就是明顯的垃圾，不用勞駕解析器
+                if text[0] not in '[{':
+                    logging.error("Gemini 回傳非 JSON: %r", text[:120])
+                    return []
+            head = head or text[:120]
+            coro.send(text.encode())
+            _drain()
+        coro.close()
+        _drain()
+    except (ijson.JSONError, ValueError) as e:
+        logging.error("Gemini JSON 解析失敗: %s，開頭: %r", e, head)
+        return []
+    return stores
+
+# 4. 製作卡片：固定結構在 import 時序列化成模板，每張卡片只解一份新 dict 再填動態欄位
+_BUBBLE_TEMPLATE = orjson.dumps({
+    "type": "bubble",
+    "size": "micro",
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {"type": "text", "text": "", "weight": "bold", "wrap": True},
+            {"type": "text", "text": "", "size": "xs", "color": "#ffc107"},
+            {"type": "text", "text": "", "size": "xxs", "color": "#aaaaaa", "wrap": True},
+            {"type": "text", "text": "", "size": "xxs", "wrap": True, "margin": "md"}
+        ]
+    },
+    "footer": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "button",
+                "action": {
+                    "type": "uri",
+                    "label": "查看地圖",
+                    "uri": ""
+                },
+                "height": "sm",
+                "style": "link"
+            }
+        ]
+    }
+})
+
+def create_bubble(store):
+    bubble = orjson.loads(_BUBBLE_TEMPLATE)
+    texts = bubble["body"]["contents"]
+    texts[0]["text"] = store.name
+    texts[1]["text"] = f"⭐ {store.rating}"
+    texts[2]["text"] = store.address
+    texts[3]["text"] = store.description
+    # 店名要先 URL 編碼，不然空白/中文/& 會讓 LINE 以 400 拒收整包訊息
+    query = store.name.strip() or store.address
+    bubble["footer"]["contents"][0]["action"]["uri"] = \
+        f"https://www.google.com/maps/search/?api=1&query={quote_plus(query)}"
+    return bubble
+
+# 5. 回覆訊息 (直接打 LINE Reply API)
+def reply_message(reply_token, messages):
+    resp = http_client.post(
+        LINE_REPLY_URL,
+        json={"replyToken": reply_token, "messages": messages}
+    )
+    resp.raise_for_status()
+
+# reply_token 是 LINE 發的英數字串，直接拼進序列化好的 bytes 不用跑一次 JSON encode
+def reply_serialized(reply_token, messages_body):
+    resp = http_client.post(
+        LINE_REPLY_URL,
+        content=b'{"replyToken":"' + reply_token.encode() + b'",' + messages_body[1:],
+        headers={"Content-Type": "application/json"},
+    )
+    resp.raise_for_status()
+
+# 6. 快取層：正規化輸入當 key，存「序列化好的 messages bytes」，
+#    命中時不重打 Gemini、不重組卡片、也不重新序列化，直接拼上 reply_token 送出
+def _normalize(value):
+    return value.strip().lower()
+
+def get_reply_body(location, food_types, budget):
+    # 種類是用 [,\s]+ 切出來的，不可能含空白，拿空白當分隔 key 才不會撞
+    # (用 + 的話，單一種類「b+c」會跟兩種類「b c」拿到同一個 key)
+    key = f"reply:{location}:{' '.join(food_types)}:{budget}"
+    cached = redis_conn.get(key)
+    if cached is not None:
+        return cached
+
+    # 邊串流邊組卡片：每一間店的 JSON 一收完就先做成 bubble
+    def fetch(food_type):
+        local = []
+        stores = get_gemini_recommendation(
+            location, food_type, budget,
+            on_store=lambda store: local.append(create_bubble(store)),
+        )
+        # 解析中途失敗會回空清單：已經組好的部分卡片要跟著丟掉，回 None 表示這一路失敗
+        return local if stores else None
+
+    if len(food_types) == 1:
+        results = [fetch(food_types[0])]
+    else:
+        # 多種類併發打 Gemini：總耗時是最慢的那一路，不是逐一相加
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(fetch, food_types))
+
+    # 任何一路失敗就整包放棄，跟單一種類一樣：缺了種類的 carousel 不送出也不進快取
+    if any(result is None for result in results):
+        return None
+    bubbles = [b for result in results for b in result]
+
+    body = orjson.dumps({"messages": [{
+        "type": "flex",
+        "altText": "推薦結果",
+        "contents": {"type": "carousel", "contents": bubbles}
+    }]})
+    redis_conn.setex(key, CACHE_TTL, body)
+    return body
+
+# 每種類 3 張卡片，LINE carousel 上限 12 張；同時避免一則訊息引爆一堆付費的 Gemini 呼叫
+MAX_FOOD_TYPES = 4
+
+# 7. 背景任務：Gemini 推薦 + 組卡片 + 回覆
+def process_food_request(reply_token, location, food_types, budget):
+    # 相容佇列裡還沒消化完的舊格式 (單一字串)
+    if isinstance(food_types, str):
+        food_types = [food_types]
+    food_types = food_types[:MAX_FOOD_TYPES]
+    try:
+        body = get_reply_body(_normalize(location), [_normalize(f) for f in food_types], _normalize(budget))
+        if not body:
+            reply_message(reply_token, [{"type": "text", "text": "抱歉，AI 找不到資料。"}])
+            return
+
+        reply_serialized(reply_token, body)
+    except Exception as e:
+        logging.error("處理失敗: %s", e)
+        reply_message(reply_token, [{"type": "text", "text": "系統發生錯誤，請稍後再試。"}])